@@ -16,6 +16,8 @@ else:
 # Get sensitive configuration from environment variables
 MATCHMINER_SERVER = os.getenv("MATCHMINER_SERVER", "http://localhost:1952")
 TOKEN = os.getenv("TOKEN", "")
+# CA bundle to verify the Matchminer server's certificate with; TLS verification is skipped when unset
+MATCHMINER_CA_BUNDLE = os.getenv("MATCHMINER_CA_BUNDLE")
 
 # Validate required environment variables
 if not TOKEN:
@@ -29,6 +31,12 @@ PATIENT_CLINICAL_JSON_DIR = "clinical"
 PATIENT_GENOMIC_JSON_DIR = "genomic"
 PATIENT_JSON_PROCESSED_DIR = "patient_data_processed"
 
+# joined once here so callers don't rebuild them on every run
+PATIENT_CLINICAL_DIR = os.path.join(PATIENT_DIR, PATIENT_CLINICAL_JSON_DIR)
+PATIENT_GENOMIC_DIR = os.path.join(PATIENT_DIR, PATIENT_GENOMIC_JSON_DIR)
+PATIENT_CLINICAL_PROCESSED_DIR = os.path.join(PATIENT_JSON_PROCESSED_DIR, PATIENT_CLINICAL_JSON_DIR)
+PATIENT_GENOMIC_PROCESSED_DIR = os.path.join(PATIENT_JSON_PROCESSED_DIR, PATIENT_GENOMIC_JSON_DIR)
+
 
 TRIAL_DATA_BASE_DIR = os.getenv("TRIAL_DATA_BASE_DIR")
 TRIAL_NCT_DATA_DIR = os.path.join(TRIAL_DATA_BASE_DIR, "cache", "nct")
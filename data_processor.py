@@ -5,19 +5,13 @@ Data Processor for Matchminer's trial data files and patient data files.
 
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from loguru import logger
 
 # Add file logging
-logger.add('logs/data_processor.log', rotation='10 MB', encoding="utf-8", format="{time} {level} - Line: {line} - {message}", level="INFO")
-
-# Import the processing functions
-try:
-    from patient import insert_all_patient_documents
-    from trial import process_trials
-except ImportError as e:
-    logger.error(f"Error importing modules: {e}")
-    sys.exit(1)
+# enqueue=True hands records to a background writer thread so processing doesn't block on file I/O
+logger.add('logs/data_processor.log', rotation='10 MB', encoding="utf-8", format="{time} {level} - Line: {line} - {message}", level="INFO", enqueue=True)
 
 class DataProcessor:
     def __init__(self):
@@ -27,38 +21,51 @@ class DataProcessor:
         """Process all files."""
         logger.info(f"Processing files at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         
-        success = True
-        
-        # Process patient files
+        # Imported here rather than at module level so importing this module doesn't pull in
+        # config/requests; sys.modules caches them after the first call.
+        # Done before starting the workers so both threads see fully imported modules.
         try:
-            logger.info("Processing patient files...")
-            patient_success = insert_all_patient_documents()
-            if patient_success:
-                logger.info("Patient files processed successfully")
-            else:
-                logger.warning("No patient files to process or processing failed")
-        except Exception as e:
-            logger.error(f"Patient files failed: {e}")
-            success = False
+            from patient import insert_all_patient_documents
+            from trial import process_trials
+            from system import run_matchengine
+        except ImportError as e:
+            logger.error(f"Error importing modules: {e}")
+            return False
+        
+        # Patient and trial processing hit independent endpoints and are I/O-bound, so run them side by side
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            patient_future = executor.submit(self._run_step, "Patient files", insert_all_patient_documents)
+            trial_future = executor.submit(self._run_step, "Trial files", process_trials)
+            patient_ok, patient_changed = patient_future.result()
+            trial_ok, trial_changed = trial_future.result()
         
-        # Process trial files
+        # Run matchengine once, after both steps have finished writing, so a run never starts mid-update
+        if patient_changed or trial_changed:
+            run_matchengine()
+        
+        return patient_ok and trial_ok
+    
+    def _run_step(self, label, process):
+        """
+        Run one processing function.
+        Returns (ok, changed): ok is False only if it raised, changed is True if it inserted or updated any data.
+        """
         try:
-            logger.info("Processing trial files...")
-            trial_success = process_trials()
-            if trial_success:
-                logger.info("Trial files processed successfully")
-            else:
-                logger.warning("No trial files to process or processing failed")
+            logger.info(f"Processing {label.lower()}...")
+            if process():
+                logger.info(f"{label} processed successfully")
+                return True, True
+            logger.warning(f"No {label.lower()} to process or processing failed")
         except Exception as e:
-            logger.error(f"Trial files failed: {e}")
-            success = False
-        
-        return success
+            logger.error(f"{label} failed: {e}")
+            return False, False
+        return True, False
 
 def main():
     """Main entry point - processes files once and exits."""
     processor = DataProcessor()
     success = processor.process_files()
+    logger.complete()
     sys.exit(0 if success else 1)
 
 if __name__ == "__main__":
@@ -1,67 +1,58 @@
 import urllib.parse
 import csv
+import pickle
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from loguru import logger
 import config
+import http_session
 import requests
-import json
+import orjson
 
 FOUNDATION_MED_SUMMARY_PATH = Path(__file__).with_name("foundation_med_summary_grouped.csv")
+TRIAL_MATCH_FETCH_WORKERS = 4 # concurrent trial_match batch queries; must not exceed the session's pool size
 
-def get_all_case_report_clinical():    
-    try:
-        endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", "/api/clinical")}'
-        headers = {
-            'Authorization': f"Basic {config.TOKEN}",
-            'Content-Type': "application/json"
-        }
-       
-        response = requests.get(endpoint_url, headers=headers, verify=False)
-        response.raise_for_status()
-        data = response.json()
-        items = data.get("_items", [])
-        return items
-    except requests.exceptions.HTTPError as err:
-        logger.error(f"HTTP error occurred: {err}, {err.response.content}")
-    except Exception as err:
-        logger.error(f"Other error occurred: {err}")
-    return None
+SESSION = http_session.make_session(pool_size=10)
+
+def get_all_case_report_clinical():
+    """
+    Yield clinical records (_id only) page by page.
+    Request errors are raised, so a failed page never passes for the end of the collection.
+    """
+    endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", "/api/clinical")}'
+    # the records are only counted, so don't pull the full clinical documents
+    params = {
+        'projection': orjson.dumps({"_id": 1}).decode(),
+        'max_results': 1000,
+    }
+    yield from http_session.iter_items(SESSION, endpoint_url, params)
 
 def get_all_case_report_genomic():
-    
-    try:
-        endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", "/api/genomic")}'
-        headers = {
-            'Authorization': f"Basic {config.TOKEN}",
-            'Content-Type': "application/json"
-        }
-       
-        response = requests.get(endpoint_url, headers=headers, verify=False)
-        response.raise_for_status()
-        data = response.json()
-        items = data.get("_items", [])
-        return items
-    except requests.exceptions.HTTPError as err:
-        logger.error(f"HTTP error occurred: {err}, {err.response.content}")
-    except Exception as err:
-        logger.error(f"Other error occurred: {err}")
-    return None
+    """
+    Yield genomic records (CLINICAL_ID only) page by page.
+    Request errors are raised, so a failed page never passes for the end of the collection.
+    """
+    endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", "/api/genomic")}'
+    # only CLINICAL_ID is read downstream, so don't pull the full genomic documents
+    params = {
+        'projection': orjson.dumps({"CLINICAL_ID": 1}).decode(),
+        'max_results': 1000,
+    }
+    yield from http_session.iter_items(SESSION, endpoint_url, params)
 
 def get_case_report_genomic_by_clinical_id(clinical_id:str):
     
     try:
         endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", "/api/genomic")}'
-        headers = {
-            'Authorization': f"Basic {config.TOKEN}",
-            'Content-Type': "application/json"
-        }
 
         params = {
-            'where': json.dumps({"CLINICAL_ID":clinical_id})}
+            'where': orjson.dumps({"CLINICAL_ID":clinical_id}).decode()}
        
-        response = requests.get(endpoint_url, headers=headers, params = params, verify=False)
+        response = SESSION.get(endpoint_url, params = params)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         items = data.get("_items", [])
         return items
     except requests.exceptions.HTTPError as err:
@@ -70,50 +61,80 @@ def get_case_report_genomic_by_clinical_id(clinical_id:str):
         logger.error(f"Other error occurred: {err}")
     return None
 
-def get_trial_matches():
-    
-    try:
-        test_clinical_ids = ["6913104e09d08e8e768aa1d5", "6913101309d08e8e768a8f97"]
-        endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", "/api/trial_match")}'
-        headers = {
-            'Authorization': f"Basic {config.TOKEN}",
-            'Content-Type': "application/json"
-        }
-        # Build filter for protocol_no
+def get_trial_matches(clinical_ids=None):
+    """
+    Yield visible trial matches.
+    If clinical_ids is given, only matches for those clinical IDs are requested from the server,
+    in batches that are fetched concurrently. Request errors are raised to the caller.
+    """
+    endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", "/api/trial_match")}'
+    # only the fields compute_case_report_stats reads
+    projection = orjson.dumps({
+        "sample_id": 1,
+        "match_type": 1,
+        "protocol_no": 1,
+        "clinical_id": 1,
+    }).decode()
+    where = {"show_in_ui": True, "is_disabled": False}
+
+    if clinical_ids is None:
+        where_clauses = [where]
+    else:
+        where_clauses = http_session.in_filters("clinical_id", clinical_ids, where)
+
+    def fetch(where_clause):
         params = {
-            # 'where': json.dumps({"clinical_id":{ "$in": test_clinical_ids },"show_in_ui":True,"is_disabled": False}),
-            'where': json.dumps({"show_in_ui":True,"is_disabled": False}),
-            'projection': json.dumps({
-            "sample_id": 1,
-            "oncotree_primary_diagnosis_name": 1,
-            "match_type": 1,
-            "sort_order": 1,
-            "protocol_no": 1,
-            "clinical_id": 1,
-    })
+            'where': orjson.dumps(where_clause).decode(),
+            'projection': projection,
+            'max_results': 1000,
         }
-        response = requests.get(endpoint_url, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-        data = response.json()
-        items = data.get("_items", [])
-        return items
-    except requests.exceptions.HTTPError as err:
-        logger.error(f"HTTP error occurred: {err}, {err.response.content}")
-    except Exception as err:
-        logger.error(f"Other error occurred: {err}")
-    return None
+        return list(http_session.iter_items(SESSION, endpoint_url, params))
+
+    # the batches are independent queries, so fetch them concurrently over the pooled session.
+    # executor.map would submit every batch up front and hold the results of those that finish early,
+    # so submit only as far ahead as there are workers: at most that many whole batches are held at once
+    with ThreadPoolExecutor(max_workers=TRIAL_MATCH_FETCH_WORKERS) as executor:
+        pending = deque()
+        for where_clause in where_clauses:
+            pending.append(executor.submit(fetch, where_clause))
+            if len(pending) >= TRIAL_MATCH_FETCH_WORKERS:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
 
+@lru_cache(maxsize=1)
 def load_arbitrary_sample_mapping(csv_path: Path = FOUNDATION_MED_SUMMARY_PATH) -> dict[str, list[str]]:
     """
     Return {arbitrary_id -> [sample_id, ...]} based on the aggregated Foundation Medicine CSV.
+    The parsed mapping is also kept in a pickle next to the CSV and reused until the CSV is modified.
+    The result is cached, so treat it as read-only.
     """
+    sidecar_path = csv_path.with_suffix(".pkl")
+    try:
+        if sidecar_path.stat().st_mtime_ns >= csv_path.stat().st_mtime_ns:
+            return pickle.loads(sidecar_path.read_bytes())
+    except FileNotFoundError:
+        pass # no sidecar yet (or no CSV, reported below)
+    except Exception as err:
+        logger.warning(f"Ignoring unreadable Foundation Medicine cache {sidecar_path}: {err}")
+
     mapping: dict[str, list[str]] = {}
     try:
         with csv_path.open(encoding="utf-8", newline="") as csvfile:
-            reader = csv.DictReader(csvfile)
+            # plain rows indexed by header position; DictReader would build a dict per row
+            reader = csv.reader(csvfile)
+            header = next(reader, [])
+            if "arbitrary_id" not in header or "report_ids" not in header:
+                logger.error(f"Foundation Medicine summary file {csv_path} is missing the arbitrary_id/report_ids columns")
+                return mapping
+            arbitrary_id_index = header.index("arbitrary_id")
+            report_ids_index = header.index("report_ids")
+            min_row_length = max(arbitrary_id_index, report_ids_index) + 1
             for row in reader:
-                arbitrary_id = (row or {}).get("arbitrary_id")
-                sample_ids_raw = (row or {}).get("report_ids")
+                if len(row) < min_row_length:
+                    continue
+                arbitrary_id = row[arbitrary_id_index]
+                sample_ids_raw = row[report_ids_index]
                 if not arbitrary_id or not sample_ids_raw:
                     continue
                 sample_ids = [sample.strip() for sample in sample_ids_raw.split(",") if sample.strip()]
@@ -121,132 +142,161 @@ def load_arbitrary_sample_mapping(csv_path: Path = FOUNDATION_MED_SUMMARY_PATH)
                     mapping[arbitrary_id] = sample_ids
     except FileNotFoundError:
         logger.warning(f"Foundation Medicine summary file not found at {csv_path}")
+        return mapping
     except Exception as err:
         logger.error(f"Failed to load Foundation Medicine summary file: {err}")
+        return mapping
+
+    try:
+        sidecar_path.write_bytes(pickle.dumps(mapping, protocol=pickle.HIGHEST_PROTOCOL))
+    except OSError as err:
+        logger.warning(f"Could not write Foundation Medicine cache {sidecar_path}: {err}")
     return mapping
 
-def organize_matches_by_protocol_and_type(matches, case_reports_with_genomic_data: set[str]):
+def compute_case_report_stats(matches, case_reports_with_genomic_data: set[str]):
     """
-    Build {case_report_sample_id -> {protocol_no -> {gene_type_match_count, generic_clinical_match_count}}}.
+    Build {case_report_sample_id -> {total_trials_matched, trials_matched_by_gene_type, total_gene_type_matches_across_all_trials}}
+    in a single pass over the matches, without an intermediate per-protocol structure.
     """
-    matches_per_case_report = {}
+    # per sample_id: [protocols matched, protocols with a gene-level match, number of gene-level matches];
+    # one lookup per match, and a list is cheaper to index than a dict with string keys
+    case_report_counts = defaultdict(lambda: [set(), set(), 0])
     skipped = set()
 
+    # bound once so the loop doesn't repeat the attribute lookups per match
+    has_genomic_data = case_reports_with_genomic_data.__contains__
+    skip = skipped.add
+
     for match in matches or []:
-        clinical_id = match.get("clinical_id")
-        sample_id = match.get("sample_id")
-        protocol_no = match.get("protocol_no")
-        match_type = match.get("match_type")
+        get = match.get
+        clinical_id = get("clinical_id")
+        sample_id = get("sample_id")
+        protocol_no = get("protocol_no")
+        match_type = get("match_type")
 
         if not clinical_id or not sample_id or not protocol_no or not match_type:
             continue
-        if clinical_id not in case_reports_with_genomic_data:
-            skipped.add(clinical_id)
+        if not has_genomic_data(clinical_id):
+            skip(clinical_id)
             continue
 
-        matched_protocols = matches_per_case_report.setdefault(sample_id, {})
-        match_type_counts = matched_protocols.setdefault(
-            protocol_no,
-            {"gene_type_match_count": 0, "generic_clinical_match_count": 0},
-        )
-
+        counts = case_report_counts[sample_id]
+        counts[0].add(protocol_no)
         if match_type == "gene":
-            match_type_counts["gene_type_match_count"] += 1
-        elif match_type == "generic_clinical":
-            match_type_counts["generic_clinical_match_count"] += 1
+            counts[1].add(protocol_no)
+            counts[2] += 1
 
-    logger.info(f"Number of case_reports with trial matches: {len(matches_per_case_report)}")
+    logger.info(f"Number of case_reports with trial matches: {len(case_report_counts)}")
     logger.info(f"Skipped case_reports IDs count: {len(skipped)}")
-    return matches_per_case_report
-
-def compute_trial_match_stats(matches_by_case_report):
-    """
-    Compute summary statistics for the organized matches structure and aggregate them per arbitrary_id.
-    """
-
-    #get stats per case report (per sample_id in MM DB)
-    stats_per_case_report = {}
-    for sample_id, protocols in matches_by_case_report.items(): #matches_by_case_report contains only the case reports with genomic data
-        gene_trials = sum(1 for counts in protocols.values() if counts["gene_type_match_count"] > 0)
-        gene_matches = sum(counts["gene_type_match_count"] for counts in protocols.values())
-        total_trials = len(protocols)
 
-        stats_per_case_report[sample_id] = { #stats_per_case_report contains stats only for the case reports with genomic data
-            "total_trials_matched": total_trials,
-            "trials_matched_by_gene_type": gene_trials,
+    return {
+        sample_id: {
+            "total_trials_matched": len(protocols),
+            "trials_matched_by_gene_type": len(gene_protocols),
             "total_gene_type_matches_across_all_trials": gene_matches,
         }
+        for sample_id, (protocols, gene_protocols, gene_matches) in case_report_counts.items()
+    }
+
+def compute_trial_match_stats(stats_per_case_report):
+    """
+    Aggregate the per-case_report stats per arbitrary_id.
+    """
+    if not stats_per_case_report: # nothing to aggregate, so don't read the CSV
+        return {}
     mapping = load_arbitrary_sample_mapping() #this will load foundation medicine patients that may or may not have genomic data
     stats_per_arbitrary_id = {}
 
     #get stats per arbitrary_id (per patient)
     aggregated_samples = set()
     for arbitrary_id, sample_ids in mapping.items(): #looping through foundation med patients with or without genomic data
-        aggregated = {
-            "total_trials_matched": 0,
-            "trials_matched_by_gene_type": 0,
-            "total_gene_type_matches_across_all_trials": 0,
-        }
+        # sum into locals and build the dict only for arbitrary_ids that have matches
+        total_trials = gene_trials = gene_matches = 0
         for sample_id in sample_ids: #since one arbitrary_id may have multiple sample_ids, we sum up the numbers for all sample_ids
             sample_stats = stats_per_case_report.get(sample_id)
             if not sample_stats: # filtering out foundation medicine patient without genomic data
                 continue
             aggregated_samples.add(sample_id)
-            aggregated["total_trials_matched"] += sample_stats["total_trials_matched"]
-            aggregated["trials_matched_by_gene_type"] += sample_stats["trials_matched_by_gene_type"]
-            aggregated["total_gene_type_matches_across_all_trials"] += sample_stats["total_gene_type_matches_across_all_trials"]
+            total_trials += sample_stats["total_trials_matched"]
+            gene_trials += sample_stats["trials_matched_by_gene_type"]
+            gene_matches += sample_stats["total_gene_type_matches_across_all_trials"]
 
-        if any(aggregated.values()):
-            stats_per_arbitrary_id[arbitrary_id] = aggregated
+        if total_trials or gene_trials or gene_matches:
+            stats_per_arbitrary_id[arbitrary_id] = {
+                "total_trials_matched": total_trials,
+                "trials_matched_by_gene_type": gene_trials,
+                "total_gene_type_matches_across_all_trials": gene_matches,
+            }
 
     for sample_id, sample_stats in stats_per_case_report.items():
         if sample_id in aggregated_samples:
             continue
-        stats_per_arbitrary_id[sample_id] = {
-            "total_trials_matched": sample_stats["total_trials_matched"],
-            "trials_matched_by_gene_type": sample_stats["trials_matched_by_gene_type"],
-            "total_gene_type_matches_across_all_trials": sample_stats["total_gene_type_matches_across_all_trials"],
-        }
+        stats_per_arbitrary_id[sample_id] = sample_stats # already in the output shape, and not modified afterwards
 
     if not stats_per_arbitrary_id and stats_per_case_report:
         logger.warning("No arbitrary ID aggregates created; check CSV mapping inputs.")
     return stats_per_arbitrary_id
 
+def count_case_reports() -> int:
+    """
+    Return the number of clinical records (case_reports) without keeping them in memory.
+    """
+    return sum(1 for _ in get_all_case_report_clinical())
+
+def get_case_reports_with_genomic_data() -> set[str]:
+    """
+    Return the unique clinical IDs of case_reports that have genomic data.
+    """
+    return {rec["CLINICAL_ID"] for rec in get_all_case_report_genomic() if rec.get("CLINICAL_ID")}
+
 def main():
-    all_case_reports = 0
-    all_clinical = get_all_case_report_clinical()
-    if all_clinical:
-        all_case_reports = len(all_clinical)
+    # clinical and genomic fetches are independent, so run them concurrently;
+    # trial matches wait for the genomic IDs because they are filtered by them on the server
+    try:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            clinical_future = executor.submit(count_case_reports)
+            genomic_future = executor.submit(get_case_reports_with_genomic_data)
+            all_case_reports = clinical_future.result()
+            case_reports_with_genomic_data = genomic_future.result()
+    except requests.exceptions.HTTPError as err:
+        logger.error(f"HTTP error occurred: {err}, {err.response.content}")
+        return
+    except Exception as err:
+        logger.error(f"Other error occurred: {err}")
+        return
+
+    if all_case_reports:
         logger.info(f"Total case_reports: {all_case_reports}")
     else:
         logger.error("No clinical data found")
         return
     
-    case_reports_with_genomic_data = set()   # this will store the unique clinical IDs of case_reports with genomic data
-
-    all_genomic = get_all_case_report_genomic()
-    if all_genomic:
-        for rec in all_genomic:
-            clinical_id = rec.get("CLINICAL_ID")
-            if clinical_id:
-                case_reports_with_genomic_data.add(clinical_id)
-    
     case_reports_with_genomic_data_count = len(case_reports_with_genomic_data)
     logger.info(f"Total case_reports with genomic records: {case_reports_with_genomic_data_count}")
     
-    # Get all trial matches and organize by clinical_id, protocol_no, and match_type counts
-    matches = get_trial_matches()
-    if matches:
-        matches_per_case_report = organize_matches_by_protocol_and_type(matches, case_reports_with_genomic_data)        
-        logger.debug(f'Trial matches per case_report {matches_per_case_report}')
+    # Stream trial matches for case_reports with genomic data only, and count trials/gene matches per case_report
+    # the stats are only reported from complete data, so stop if any page of matches fails
+    try:
+        matches = get_trial_matches(clinical_ids=case_reports_with_genomic_data)
+        stats_per_case_report = compute_case_report_stats(matches, case_reports_with_genomic_data)
+    except requests.exceptions.HTTPError as err:
+        logger.error(f"HTTP error occurred: {err}, {err.response.content}")
+        return
+    except Exception as err:
+        logger.error(f"Other error occurred: {err}")
+        return
+    if stats_per_case_report:
+        logger.debug(f'Trial match stats per case_report {stats_per_case_report}')
 
-        stats_per_arbitrary_id = compute_trial_match_stats(matches_per_case_report)
+        stats_per_arbitrary_id = compute_trial_match_stats(stats_per_case_report)
         logger.debug(f'Stats per arbitrary_id: {stats_per_arbitrary_id}')
 
         arbitrary_id_count = len(stats_per_arbitrary_id) #unique patients with genomic data and atleast 1 trial match
 
-        total_trials = sum(s["total_trials_matched"] for s in stats_per_arbitrary_id.values())
-        total_gene_trials = sum(s["trials_matched_by_gene_type"] for s in stats_per_arbitrary_id.values())
+        total_trials = total_gene_trials = 0
+        for s in stats_per_arbitrary_id.values():
+            total_trials += s["total_trials_matched"]
+            total_gene_trials += s["trials_matched_by_gene_type"]
 
         avg_trials = (total_trials / arbitrary_id_count) if arbitrary_id_count else 0
         avg_gene_trials = (total_gene_trials / arbitrary_id_count) if arbitrary_id_count else 0
@@ -265,7 +315,6 @@ def main():
         logger.info("------------------------------------------------------------")
     else:
         logger.warning("No trial matches found")
-        matches_per_case_report = {}
     
 if __name__ == "__main__":
     logger.add('match_stats.log', rotation = '1 MB', encoding="utf-8", format="{time} {level} - Line: {line} - {message}", level="INFO")
@@ -0,0 +1,87 @@
+"""
+Shared HTTP setup for the calls made to the Matchminer (Eve) server.
+"""
+
+import functools
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
+import config
+
+IN_FILTER_BATCH_SIZE = 100 # IDs per `$in` filter; keeps the encoded `where` well under URL length limits
+
+def make_session(pool_size: int = 10) -> requests.Session:
+    """
+    Build a requests.Session for the Matchminer server, so connections are kept alive between requests.
+
+    Parameters:
+    pool_size (int): Connections kept per host; should cover the number of threads sharing the session
+
+    Returns:
+    requests.Session: Session with auth headers, retries and TLS verification configured
+    """
+    session = requests.Session()
+    # Retry's defaults don't retry POST, so a failed insert is never sent twice
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({
+        'Authorization': f"Basic {config.TOKEN}",
+        'Content-Type': "application/json"
+    })
+    # the server uses a self-signed certificate: verify it against MATCHMINER_CA_BUNDLE when one is configured,
+    # otherwise skip verification and silence the InsecureRequestWarning urllib3 would emit on every request.
+    # session.verify alone is not enough: when REQUESTS_CA_BUNDLE or CURL_CA_BUNDLE is set, requests fills a request's
+    # verify from the environment and that wins over session.verify, so pass it explicitly on every request
+    verify = config.MATCHMINER_CA_BUNDLE or False
+    session.verify = verify
+    session.request = functools.partial(session.request, verify=verify)
+    if not verify:
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    return session
+
+def iter_items(session: requests.Session, endpoint_url: str, params: dict):
+    """
+    Yield `_items` from every page of an Eve collection, following `_links.next` until it is absent.
+    Only one page is held in memory at a time. Request errors are raised to the caller.
+    """
+    page = 1
+    while True:
+        response = session.get(endpoint_url, params={**params, 'page': page})
+        response.raise_for_status()
+        data = orjson.loads(response.content)
+        yield from data.get("_items", [])
+        if "next" not in data.get("_links", {}):
+            return
+        page += 1
+
+def in_filters(field: str, ids, where: dict = None, batch_size: int = IN_FILTER_BATCH_SIZE):
+    """
+    Yield Eve `where` filters matching `field` against batches of `ids`, each combined with `where`.
+    The filter goes in the query string, so the IDs are split to keep each URL a sane length.
+    """
+    ids = list(ids)
+    for start in range(0, len(ids), batch_size):
+        yield {**(where or {}), field: {"$in": ids[start:start + batch_size]}}
+
+def post_bulk(session: requests.Session, endpoint_url: str, documents: list) -> list:
+    """
+    Insert several documents with one POST (Eve bulk insert).
+    Eve rejects the whole request if one document is invalid, so callers retry a failed bulk insert document by document
+    to get the valid ones in. Request errors are raised to the caller.
+
+    Parameters:
+    session (requests.Session): Session from make_session
+    endpoint_url (str): URL of the Eve collection
+    documents (list): Documents to insert
+
+    Returns:
+    list: Inserted items (with their '_id') in the order they were posted
+    """
+    response = session.post(endpoint_url, data=orjson.dumps(documents))
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    return data.get('_items', [data]) # Eve answers a one-document list with the document itself
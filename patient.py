@@ -7,16 +7,33 @@ data and proceeds to insert genomic data into the Matchminer system.
 """
 
 import os
-import json
+import errno
+import shutil
+import time
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import urllib.parse
 from loguru import logger
 import config
+import http_session
 import system
 
+PATIENT_UPLOAD_WORKERS = 8 # patient files uploaded concurrently
+PATIENT_BULK_INSERT_SIZE = 500 # clinical documents per bulk POST, to keep each request body a sane size
+GENOMIC_BULK_INSERT_SIZE = 5000 # genomic records per bulk POST; patients have many records each
+
+SESSION = http_session.make_session(pool_size=16)
+
 def insert_all_patient_documents():
-    clinical_data_path = os.path.join(config.PATIENT_DIR, config.PATIENT_CLINICAL_JSON_DIR)
-    genomic_data_path = os.path.join(config.PATIENT_DIR, config.PATIENT_GENOMIC_JSON_DIR)
+    """
+    Insert all pending patient files. Matchengine is not run here, so the caller can run it once after all processing.
+
+    Returns:
+    bool: True if any patient was inserted
+    """
+    clinical_data_path = config.PATIENT_CLINICAL_DIR
+    genomic_data_path = config.PATIENT_GENOMIC_DIR
     
     # Check if reviewed clinical folder exists
     if not os.path.exists(clinical_data_path):
@@ -26,76 +43,189 @@ def insert_all_patient_documents():
     if not os.path.exists(genomic_data_path):
         os.makedirs(genomic_data_path, exist_ok=True)
     
+    # scandir's DirEntry.is_file() uses the type from the directory read, so no extra stat per file
+    with os.scandir(clinical_data_path) as entries:
+        files = [entry.name for entry in entries if entry.name.endswith(".json") and entry.is_file()]
+
+    if not files:
+        logger.info(f"No pending patient files in {clinical_data_path}")
+        return False
+
+    # one directory read answers "does this patient have a genomic file?" for every file
+    with os.scandir(genomic_data_path) as entries:
+        genomic_files = {entry.name for entry in entries if entry.is_file()}
+
     # Create processed folders if they don't exist
-    processed_clinical_folder = os.path.join(config.PATIENT_JSON_PROCESSED_DIR, config.PATIENT_CLINICAL_JSON_DIR)
-    processed_genomic_folder = os.path.join(config.PATIENT_JSON_PROCESSED_DIR, config.PATIENT_GENOMIC_JSON_DIR)
+    processed_clinical_folder = config.PATIENT_CLINICAL_PROCESSED_DIR
+    processed_genomic_folder = config.PATIENT_GENOMIC_PROCESSED_DIR
     
     if not os.path.exists(processed_clinical_folder):
         os.makedirs(processed_clinical_folder, exist_ok=True)
     if not os.path.exists(processed_genomic_folder):
         os.makedirs(processed_genomic_folder, exist_ok=True)
+
+    return bool(_insert_patient_files_in_bulk(files, genomic_files))
+
+def _load_patient_files(file: str, has_genomic_file: bool):
+    """
+    Load and check a pending patient's clinical file and, if present, its genomic file, so that a malformed patient
+    is left pending before anything is posted instead of failing halfway through its insert.
+
+    Parameters:
+    file (str): File name, shared by the clinical and genomic JSON files
+    has_genomic_file (bool): Whether a genomic JSON file with the same name is pending
+
+    Returns:
+    tuple or None: (clinical_data, genomic_data or None), or None if either file is unreadable or malformed
+    """
+    clinical_data = load_json(os.path.join(config.PATIENT_CLINICAL_DIR, file))
+    if clinical_data is None:
+        return None
+    if not isinstance(clinical_data, dict) or "SAMPLE_ID" not in clinical_data:
+        logger.error(f"Clinical data in {file} has no SAMPLE_ID, leaving the patient pending")
+        return None
+
+    genomic_data = None
+    if has_genomic_file:
+        genomic_data = load_json(os.path.join(config.PATIENT_GENOMIC_DIR, file))
+        if genomic_data is None:
+            return None
+        if not isinstance(genomic_data, list) or not all(isinstance(item, dict) for item in genomic_data):
+            logger.error(f"Genomic data in {file} is not a list of records, leaving the patient pending")
+            return None
+    return clinical_data, genomic_data
+
+def _add_clinical_ids(genomic_data: list, clinical_id: str, clinical_data: dict):
+    """Link each genomic record to its patient's inserted clinical document."""
+    for item in genomic_data:
+        item["CLINICAL_ID"] = clinical_id
+        item["SAMPLE_ID"] = clinical_data["SAMPLE_ID"]
+
+def _insert_patient_file(file: str, clinical_data: dict, genomic_data) -> bool:
+    """
+    Insert one pending patient's clinical data and, if present, its genomic data, then move both files to the processed folders.
+
+    Parameters:
+    file (str): File name, shared by the clinical and genomic JSON files
+    clinical_data (dict): The patient's clinical document
+    genomic_data (list or None): The patient's genomic records, or None if there is no genomic file
+
+    Returns:
+    bool: True if the clinical data was inserted, False otherwise
+    """
+    clinical_id = post_clinical_data(clinical_data, file)
+    if not clinical_id:
+        logger.error(f"Failed to get clinical ID for {file}. Skipping genomic data.")
+        return False
+
+    if genomic_data is not None:
+        _add_clinical_ids(genomic_data, clinical_id, clinical_data)
+        post_genomic_data(genomic_data, file)
     
-    files = [f for f in os.listdir(clinical_data_path) if f.endswith(".json")]
+    # Clinical data was successfully inserted, so consider it a success
+    _move_patient_files(file, genomic_data is not None)
+    return True
+
+def _insert_patient_files_in_bulk(files: list, genomic_files: set) -> list:
+    """
+    Insert the clinical data of the pending patients with bulk POSTs, then their genomic data with further bulk POSTs,
+    and move the inserted files to the processed folders.
+    Malformed patients are skipped and left pending; a batch whose bulk clinical insert fails is inserted file by file.
 
-    any_success = False
+    Parameters:
+    files (list): File names, each shared by a clinical and an optional genomic JSON file
+    genomic_files (set): Names of the pending genomic JSON files
+
+    Returns:
+    list: Files whose clinical data was inserted
+    """
+    prepared = [] # (file, clinical_data, genomic_data or None) for every patient that passed the checks
     for file in files:
-        clinical_full_path = os.path.join(clinical_data_path, file)
-        if not os.path.isfile(clinical_full_path):
-            continue
-        
-        clinical_data = load_json(clinical_full_path)
-        if clinical_data is None:
-            continue
+        patient = _load_patient_files(file, file in genomic_files)
+        if patient is not None:
+            prepared.append((file, *patient))
+
+    clinical_url = urllib.parse.urljoin(config.MATCHMINER_SERVER, config.CLINICAL_ENDPOINT)
+    inserted_files = []
+    with ThreadPoolExecutor(max_workers=PATIENT_UPLOAD_WORKERS) as executor:
+        for start in range(0, len(prepared), PATIENT_BULK_INSERT_SIZE):
+            batch = prepared[start:start + PATIENT_BULK_INSERT_SIZE]
+            clinical_items = make_bulk_post_request(clinical_url, [clinical_data for _, clinical_data, _ in batch], "clinical")
+            if clinical_items is None:
+                # insert this batch file by file so the valid patients still get in;
+                # each file's clinical POST -> genomic POST -> move chain is independent of the others and
+                # mostly waits on the network, so overlap the files on the thread pool
+                logger.warning("Bulk clinical insert failed, falling back to per-file inserts")
+                inserted = executor.map(_insert_patient_file, *zip(*batch)) # file, clinical_data, genomic_data columns
+                inserted_files.extend(file for (file, _, _), success in zip(batch, inserted) if success)
+                continue
+
+            try:
+                # Eve returns the inserted items in the order they were posted
+                genomic_per_file = [] # (file, genomic_data) with CLINICAL_ID/SAMPLE_ID filled in
+                for (file, clinical_data, genomic_data), clinical_item in zip(batch, clinical_items):
+                    if genomic_data is not None:
+                        _add_clinical_ids(genomic_data, clinical_item["_id"], clinical_data)
+                        genomic_per_file.append((file, genomic_data))
+                _post_genomic_data_in_bulk(genomic_per_file)
+            except Exception as err:
+                logger.error(f"Other error occurred for bulk genomic insert: {err}")
+            finally:
+                # the clinical data is in, so the files must leave the pending folder or the next run inserts them again
+                for file, _, genomic_data in batch:
+                    _move_patient_files(file, genomic_data is not None)
+                    inserted_files.append(file)
+    return inserted_files
 
-        clinical_id = post_clinical_data(clinical_data, file)
-        if not clinical_id:
-            logger.error(f"Failed to get clinical ID for {file}. Skipping genomic data.")
+def _post_genomic_data_in_bulk(genomic_per_file: list):
+    """
+    POST the genomic records of several patients in batches of about GENOMIC_BULK_INSERT_SIZE records.
+    A patient's records are never split across batches, so a failed batch can be retried patient by patient.
+
+    Parameters:
+    genomic_per_file (list): (file, genomic_data) for each patient, with CLINICAL_ID/SAMPLE_ID filled in
+    """
+    genomic_url = urllib.parse.urljoin(config.MATCHMINER_SERVER, config.GENOMIC_ENDPOINT)
+    batch, batch_size = [], 0
+    for index, (file, genomic_data) in enumerate(genomic_per_file):
+        batch.append((file, genomic_data))
+        batch_size += len(genomic_data)
+        if batch_size < GENOMIC_BULK_INSERT_SIZE and index < len(genomic_per_file) - 1:
             continue
+        genomic_documents = [item for _, batch_data in batch for item in batch_data]
+        if genomic_documents and make_bulk_post_request(genomic_url, genomic_documents, "genomic") is None:
+            # retry per file so only the invalid file's genomic data is lost
+            for batch_file, batch_data in batch:
+                post_genomic_data(batch_data, batch_file)
+        batch, batch_size = [], 0
 
-        genomic_document_full_path = os.path.join(genomic_data_path, file)
-        genomic_success = False
-        
-        if os.path.isfile(genomic_document_full_path):
-            genomic_data = load_json(genomic_document_full_path)
-            if genomic_data is not None:
-                for item in genomic_data:
-                    item["CLINICAL_ID"] = clinical_id
-                    item["SAMPLE_ID"] = clinical_data["SAMPLE_ID"]
-                logger.debug(f"Genomic document: {item}")
-                genomic_success = post_genomic_data(genomic_data, file)
+def _move_patient_files(file: str, has_genomic_file: bool):
+    """
+    Move a patient's clinical file, and its genomic file if there is one, to the processed folders.
+    Failures are logged, since the data has already been inserted.
+    """
+    clinical_full_path = os.path.join(config.PATIENT_CLINICAL_DIR, file)
+    genomic_document_full_path = os.path.join(config.PATIENT_GENOMIC_DIR, file)
+    try:
+        # Move clinical file
+        clinical_dest_path = os.path.join(config.PATIENT_CLINICAL_PROCESSED_DIR, file)
+        _move_file_with_retry(clinical_full_path, clinical_dest_path)
         
-        # If clinical data was successfully inserted, consider it a success
-        if clinical_id:
-            try:
-                # Move clinical file
-                clinical_dest_path = os.path.join(processed_clinical_folder, file)
-                _move_file_with_retry(clinical_full_path, clinical_dest_path)
-                
-                # Move genomic file if it exists
-                if os.path.isfile(genomic_document_full_path):
-                    genomic_dest_path = os.path.join(processed_genomic_folder, file)
-                    _move_file_with_retry(genomic_document_full_path, genomic_dest_path)
-                
-                any_success = True
-                logger.debug(f"Successfully processed and moved files for {file}")
-            except Exception as e:
-                logger.error(f"Error moving files for {file}: {e}")
-                # Still consider it a success if data was inserted, even if file moving failed
-                any_success = True
-        else:
-            logger.debug(f"Clinical data insertion failed for {file}")
-    
-    # Call run_matchengine once after all files processed, if any were successful
-    if any_success:
-        system.run_matchengine()
+        # Move genomic file if it exists
+        if has_genomic_file:
+            genomic_dest_path = os.path.join(config.PATIENT_GENOMIC_PROCESSED_DIR, file)
+            _move_file_with_retry(genomic_document_full_path, genomic_dest_path)
         
-    return any_success
+        logger.debug(f"Successfully processed and moved files for {file}")
+    except Exception as e:
+        logger.error(f"Error moving files for {file}: {e}")
+        # Still consider it a success if data was inserted, even if file moving failed
 
 def load_json(file_path):
     """Load JSON data from a file."""
     try:
-        with open(file_path, 'r', encoding='utf-8') as json_file:
-            return json.load(json_file)
+        with open(file_path, 'rb') as json_file:
+            return orjson.loads(json_file.read())
     except Exception as e:
         logger.error(f"Failed to load JSON from {file_path}: {e}")
         return None
@@ -117,16 +247,29 @@ def post_genomic_data(genomic_data: dict, file_name: str) -> bool:
 def make_post_request(endpoint_url: str, data: dict, file_name: str) -> str:
     """General method to make a POST request and handle responses."""
     try:
-        response = requests.post(endpoint_url, json=data, headers={'Authorization': f"Basic {config.TOKEN}", 'Content-Type': 'application/json'}, verify=False)
+        response = SESSION.post(endpoint_url, json=data)
         response.raise_for_status()
 
         logger.info(f"Successfully inserted data for {file_name}")
-        return response.json().get('_id')
+        return orjson.loads(response.content).get('_id')
     except requests.exceptions.HTTPError as err:
         logger.error(f"HTTP error occurred for {file_name}: {err}, Response: {err.response.content}")
     except Exception as err:
         logger.error(f"Other error occurred for {file_name}: {err}")
 
+def make_bulk_post_request(endpoint_url: str, documents: list, description: str):
+    """
+    POST a list of documents in one request and return the inserted items (with their '_id'), or None on failure.
+    """
+    try:
+        items = http_session.post_bulk(SESSION, endpoint_url, documents)
+        logger.info(f"Successfully inserted {len(items)} {description} documents")
+        return items
+    except requests.exceptions.HTTPError as err:
+        logger.error(f"HTTP error occurred for bulk {description} insert: {err}, Response: {err.response.content}")
+    except Exception as err:
+        logger.error(f"Other error occurred for bulk {description} insert: {err}")
+
 def _move_file_with_retry(source_path, dest_path, max_retries=3, delay=1):
     """
     Move a file with retry logic to handle Windows file locking issues.
@@ -135,41 +278,38 @@ def _move_file_with_retry(source_path, dest_path, max_retries=3, delay=1):
     source_path (str): Source file path
     dest_path (str): Destination file path
     max_retries (int): Maximum number of retry attempts
-    delay (float): Delay between retries in seconds
+    delay (float): Delay before the first retry in seconds, doubled for each further retry
     """
-    import time
-    import shutil
-    
     for attempt in range(max_retries):
         try:
-            # Try rename first (more efficient)
-            os.rename(source_path, dest_path)
+            # os.replace is a single rename, and unlike os.rename it also overwrites an existing destination on Windows
+            os.replace(source_path, dest_path)
             logger.info(f"Successfully moved {source_path} to {dest_path}")
             return
         except PermissionError as e:
             if attempt < max_retries - 1:
                 logger.warning(f"Permission error moving file (attempt {attempt + 1}/{max_retries}): {e}")
-                time.sleep(delay)
+                time.sleep(delay * 2 ** attempt) # locks from virus scanners or indexers usually clear within a few seconds
                 continue
-            else:
-                # Last attempt failed, try copy and delete
-                try:
-                    logger.info(f"Attempting copy and delete for {source_path}")
-                    shutil.copy2(source_path, dest_path)
-                    os.remove(source_path)
-                    logger.info(f"Successfully copied and deleted {source_path}")
-                    return
-                except Exception as copy_error:
-                    logger.error(f"Failed to copy and delete {source_path}: {copy_error}")
-                    raise e
-        except Exception as e:
-            logger.error(f"Unexpected error moving file {source_path}: {e}")
-            raise e
+            logger.error(f"Permission error moving file {source_path} after {max_retries} attempts: {e}")
+            raise
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                logger.error(f"Unexpected error moving file {source_path}: {e}")
+                raise
+            # Destination is on another filesystem, so the file has to be copied; only the contents are needed
+            logger.info(f"Cross-device move, copying and deleting {source_path}")
+            shutil.copyfile(source_path, dest_path)
+            os.unlink(source_path)
+            logger.info(f"Successfully copied and deleted {source_path}")
+            return
 
 def main():
     # Add file logging
     logger.add('logs/patient_processor.log', rotation='10 MB', encoding="utf-8", format="{time} {level} - Line: {line} - {message}")
-    insert_all_patient_documents()
+    # Call run_matchengine once after all files processed, if any were successful
+    if insert_all_patient_documents():
+        system.run_matchengine()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -37,18 +37,20 @@ else
     
     echo "Activating newly created conda environment: $ENV_NAME"
     conda activate "$ENV_NAME"
-    
-    echo "Installing requirements from requirements.txt..."
-    if [ -f "requirements.txt" ]; then
-        pip install -r requirements.txt
-        if [ $? -ne 0 ]; then
-            echo "ERROR: Failed to install requirements"
-            exit 1
-        fi
-        echo "Requirements installed successfully"
-    else
-        echo "WARNING: requirements.txt not found, skipping package installation"
+fi
+
+# Install on every run, not only when the environment is created, so existing environments
+# pick up packages added to requirements.txt (pip skips the ones already satisfied)
+echo "Installing requirements from requirements.txt..."
+if [ -f "requirements.txt" ]; then
+    pip install -q -r requirements.txt
+    if [ $? -ne 0 ]; then
+        echo "ERROR: Failed to install requirements"
+        exit 1
     fi
+    echo "Requirements installed successfully"
+else
+    echo "WARNING: requirements.txt not found, skipping package installation"
 fi
 
 echo "Starting data processor..."
@@ -1,13 +1,35 @@
 import os
-import json
+import orjson
 from datetime import datetime
 import requests
 import urllib.parse
 from loguru import logger
 import config
-import argparse
+import http_session
 import system
 import csv
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+TRIAL_UPLOAD_WORKERS = 8 # trials posted concurrently; must not exceed the session's pool size
+TRIAL_BULK_INSERT_SIZE = 500 # trials per bulk POST, to keep each request body a sane size
+NEVER_RUN_DATE = "1900-01-01" # last run date for trials never processed before, older than any entry_last_updated_date
+TRIAL_URL = urllib.parse.urljoin(config.MATCHMINER_SERVER, config.TRIAL_ENDPOINT)
+
+# query params that never change, serialized once
+PROTOCOL_ID_NO_PROJECTION = orjson.dumps({"protocol_id": 1, "protocol_no": 1}).decode()
+NCT_ID_PROJECTION = orjson.dumps({"nct_id": 1}).decode()
+# fields Eve adds to every document, which must not be sent back in a PUT
+EVE_META_FIELDS = frozenset(('_id', '_etag', '_summary', '_updated', '_created', '_links'))
+# the fields process_trials reads from an existing trial to decide how to update it
+TRIAL_SUMMARY_PROJECTION = orjson.dumps({"_id": 1, "_etag": 1, "protocol_id": 1, "protocol_no": 1, "status": 1, "nct_id": 1}).decode()
+
+SESSION = http_session.make_session(pool_size=20)
+
+@lru_cache(maxsize=256)
+def _where_protocol_no(protocol_no: str) -> str:
+    """Return the serialized Eve `where` filter for a protocol_no."""
+    return orjson.dumps({"protocol_no": protocol_no}).decode()
 
 def load_environment_variables():
     """
@@ -20,8 +42,8 @@ def load_environment_variables():
     JSON data for trial env variables
     """
     if os.path.exists(config.TRIAL_ENV_CONFIG_PATH):
-        with open(config.TRIAL_ENV_CONFIG_PATH, 'r') as env_config:
-            return json.load(env_config)
+        with open(config.TRIAL_ENV_CONFIG_PATH, 'rb') as env_config:
+            return orjson.loads(env_config.read())
     else:
         raise Exception(f"Env config path {config.TRIAL_ENV_CONFIG_PATH} not found")
 
@@ -33,14 +55,11 @@ def post_trial(trial_data):
     trial_data (dict) : Trial Data
     """
     try:
-        endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", config.TRIAL_ENDPOINT)}'
+        endpoint_url = TRIAL_URL
         logger.debug(f"Posting request to {endpoint_url}")
 
-        headers = {}
-        headers['Authorization'] = f"Basic {config.TOKEN}"
-        headers['Content-Type'] = f"application/json"
-
-        response = requests.post(endpoint_url, json=trial_data, headers=headers, verify=False)
+        # orjson serializes straight to bytes; the session already sets the JSON Content-Type
+        response = SESSION.post(endpoint_url, data=orjson.dumps(trial_data))
         response.raise_for_status()
         return response
     except requests.exceptions.HTTPError as err:
@@ -48,6 +67,26 @@ def post_trial(trial_data):
     except Exception as err:
         logger.error(f"Other error occurred: {err}")  # Handle other exceptions
 
+def post_trials_bulk(trials: list):
+    """
+    Sends one API request to insert several trials into matchminer system.
+
+    Parameters:
+    trials (list) : Trial data of each trial
+
+    Returns:
+    list or None: Inserted items in the order they were posted, or None if the request failed
+    """
+    try:
+        logger.debug(f"Posting {len(trials)} trials to {TRIAL_URL}")
+
+        return http_session.post_bulk(SESSION, TRIAL_URL, trials)
+    except requests.exceptions.HTTPError as err:
+        logger.error(f"HTTP error occurred: {err}, {err.response.content}")  # Handle HTTP errors
+    except Exception as err:
+        logger.error(f"Other error occurred: {err}")  # Handle other exceptions
+    return None
+
 def put_trial(matchminer_id,trial_data,etag):
     """
     Sends an API request to update trial data in matchminer system.
@@ -56,16 +95,12 @@ def put_trial(matchminer_id,trial_data,etag):
     trial_data (dict) : Trial Data
     """
     try:        
-        endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", config.TRIAL_ENDPOINT)}/{matchminer_id}'
-        print(f"Posting request to {endpoint_url}")
+        endpoint_url = f'{TRIAL_URL}/{matchminer_id}'
+        logger.debug(f"Posting request to {endpoint_url}")
 
-        headers = {
-            'Authorization': f"Basic {config.TOKEN}",
-            'Content-Type': "application/json",
-            'If-Match': etag 
-        }
+        headers = {'If-Match': etag}
 
-        response = requests.put(endpoint_url, json=trial_data, headers=headers, verify=False)
+        response = SESSION.put(endpoint_url, data=orjson.dumps(trial_data), headers=headers)
         response.raise_for_status()
         return response
     except requests.exceptions.HTTPError as err:
@@ -84,22 +119,18 @@ def get_max_protocol_id_and_number():
     Tuple : max_protocol_id, max_protocol_no
     """
     try:
-        projection = {"protocol_id": 1, "protocol_no": 1}
-        params = {"projection": json.dumps(projection)}
-        endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", config.TRIAL_ENDPOINT)}'
-        
-        headers = {}
-        headers['Authorization'] = f"Basic {config.TOKEN}"
-        headers['Content-Type'] = f"application/json"
-        
-        response = requests.get(endpoint_url, headers=headers, params = params, verify=False)
-        #print(response.json())
-        response.raise_for_status()
-        data = json.loads(response.content)
-        items = data["_items"]
-        sorted_items_by_id = sorted(items, key=lambda x: x["protocol_id"])
+        # let the server sort by protocol_id and return only the top trial
+        params = {
+            "projection": PROTOCOL_ID_NO_PROJECTION,
+            "sort": '[("protocol_id", -1)]',
+            "max_results": 1,
+        }
+        endpoint_url = TRIAL_URL
 
-        max_item = sorted_items_by_id[-1]
+        response = SESSION.get(endpoint_url, params = params)
+        response.raise_for_status()
+        data = orjson.loads(response.content)
+        max_item = data["_items"][0]
 
         max_protocol_id = max_item["protocol_id"]
         max_protocol_no = max_item["protocol_no"]
@@ -122,22 +153,11 @@ def get_all_nct_ids():
     """
     try:
         nct_ids = []
-        projection = {"nct_id": 1}
-        params = {"projection": json.dumps(projection)}
-        endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", config.TRIAL_ENDPOINT)}'
-        
-        headers = {}
-        headers['Authorization'] = f"Basic {config.TOKEN}"
-        headers['Content-Type'] = f"application/json"
-        
-        response = requests.get(endpoint_url, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-        data = json.loads(response.content)
-        items = data["_items"]
+        params = {"projection": NCT_ID_PROJECTION, "max_results": 1000}
 
-        for trial in items:
-            nct_id = trial["nct_id"] 
-            if nct_id.startswith('NCT'): # means its a trial from clinicaltrials.gov
+        for trial in http_session.iter_items(SESSION, TRIAL_URL, params):
+            nct_id = trial.get("nct_id")
+            if nct_id and nct_id.startswith('NCT'): # means its a trial from clinicaltrials.gov
                 nct_ids.append(nct_id)
         return nct_ids
     except requests.exceptions.HTTPError as err:
@@ -200,22 +220,27 @@ def update_env_variables(env_variables):
 
 def save_environment_variables(env_vars):
     """
-    Save trial env variables back in config
+    Save trial env variables back in config.
+    The file is written next to the config and then moved over it, so a crash mid-write can't leave a truncated config
     """
-    with open(config.TRIAL_ENV_CONFIG_PATH, 'w') as file:
-        json.dump(env_vars, file, indent=4)
+    temp_path = f"{config.TRIAL_ENV_CONFIG_PATH}.tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(orjson.dumps(env_vars, option=orjson.OPT_INDENT_2))
+    os.replace(temp_path, config.TRIAL_ENV_CONFIG_PATH)
 
 def save_last_run_environment(last_run_date_per_trial: dict):
     """
     Update the last run date for each trial that was processed
     """   
     
-    with open('last_run_config.json', 'w') as f:
-        json.dump(last_run_date_per_trial, f, indent=2)
+    with open('last_run_config.json', 'wb') as f:
+        f.write(orjson.dumps(last_run_date_per_trial, option=orjson.OPT_INDENT_2))
     
     logger.info(f"Updated and saved last_run_config.json")
 
 def main():
+    import argparse # only needed when run as a script, not when imported by data_processor
+
     parser = argparse.ArgumentParser(description="Trial operations for Matchminer.")
     subparsers = parser.add_subparsers(dest="command", required=True)
 
@@ -241,7 +266,9 @@ def main():
     args = parser.parse_args()
 
     if args.command == "upsert":
-        process_trials()
+        # Call run_matchengine to refresh patient-trial matches once after all files processed, if any were successful
+        if process_trials():
+            system.run_matchengine()
     elif args.command == "insert":
         result = insert_new_trial(args.trial_file)
         if result:
@@ -250,7 +277,7 @@ def main():
             print("Insert failed.")    
     elif args.command == "get":
         trial = get_trial_by_protocol_no(args.protocol_no)
-        logger.debug(json.dumps(trial, indent=2) if trial else "No trial found.")
+        logger.debug(orjson.dumps(trial, option=orjson.OPT_INDENT_2).decode() if trial else "No trial found.")
     elif args.command == "update":
         result = update_trial_by_protocol_no(args.protocol_no, args.updated_trial_file)
         if result:
@@ -268,7 +295,10 @@ def process_trials():
      - calls a method to insert trial into matchminer system
      - calls a method to update trial in matchminer system
      - calls a method to close trial in matchminer system
-     - calls a method to run matchengine
+    Matchengine is not run here, so the caller can run it once after all processing.
+
+    Returns:
+    bool: True if any trial was inserted, updated or closed
     """
     # Check if trial folder exists
     if not os.path.exists(config.TRIAL_DIR):
@@ -281,33 +311,47 @@ def process_trials():
         return False
         
     try:
-        with open("last_run_config.json", "r") as f:
-            last_run_date_per_trial = json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
+        with open("last_run_config.json", "rb") as f:
+            last_run_date_per_trial = orjson.loads(f.read())
+    except (orjson.JSONDecodeError, FileNotFoundError):
         last_run_date_per_trial = {}
 
     # read trial_status.csv and filter trials to process based on last_run
-    trials_to_process = []
     logger.info(f"Preparing a list of trials to process which were updated after last matcminer_admin's run")
+    get_last_run_date = last_run_date_per_trial.get # bound once for the per-row lookups
     with open(config.TRIAL_STATUS_CSV_PATH, 'r', encoding='utf-8') as csv_file:
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            if row['nct_id'] == "NA":
-                trial_id = row['local_protocol_ids'].split('|')[0]
-            else:
-                trial_id = row['nct_id']
-            if row['entry_last_updated_date'] > last_run_date_per_trial.get(trial_id, "1900-01-01"): # if the trial is not found in last_run_date_per_trial, use a very old date, so that its processed
-                trials_to_process.append(row)
+        # trial_id is the nct_id, or the first local protocol id for trials without one.
+        # If the trial is not found in last_run_date_per_trial, use a very old date, so that its processed
+        trials_to_process = [
+            row for row in csv.DictReader(csv_file)
+            if row['entry_last_updated_date'] > get_last_run_date(
+                row['local_protocol_ids'].split('|', 1)[0] if row['nct_id'] == "NA" else row['nct_id'], NEVER_RUN_DATE)
+        ]
+
+    if not trials_to_process:
+        logger.info("No trials updated since last run, nothing to process")
+        return False
 
     trials_to_update = [] # stores filename, matchminer id, protocol_id, protocol_no of trials to update
     trials_to_insert = [] # stores filename which would contain trial data to be inserted
     trials_to_close = [] # stores matchminer id, trial data of trials to close
 
-    for trial_to_process in trials_to_process:
+    # trials with an nct_id are looked up with a few batched $in queries instead of a GET per trial
+    nct_ids = list({row['nct_id'] for row in trials_to_process if row['nct_id'] and row['nct_id'] != 'NA'})
+    trials_by_nct_id = get_trials_by_nct_ids(nct_ids)
+    if trials_by_nct_id is None:
+        # without the lookup every trial would look new and be inserted a second time
+        logger.error("Could not look up existing trials by nct_id, nothing processed")
+        return False
+
+    # the remaining lookups are independent GETs that mostly wait on the network, so run them concurrently
+    with ThreadPoolExecutor(max_workers=TRIAL_UPLOAD_WORKERS) as executor:
+        trials_in_mm = list(executor.map(_get_trial_in_mm, trials_to_process, [trials_by_nct_id] * len(trials_to_process)))
+
+    for trial_to_process, trial_in_mm in zip(trials_to_process, trials_in_mm):
         nct_id = trial_to_process['nct_id']
         file_name = _get_trial_file_name(trial_to_process)
         if nct_id and nct_id != 'NA':
-            trial_in_mm = get_trial_by_nct_id(nct_id)
             if trial_in_mm:
                 if trial_to_process['status'] == 'closed':
                     if trial_in_mm['status'] != 'closed':
@@ -321,8 +365,6 @@ def process_trials():
         else:
             local_protocol_ids_string = trial_to_process['local_protocol_ids']
             if local_protocol_ids_string and local_protocol_ids_string != 'NA':
-                local_protocol_ids = local_protocol_ids_string.split('|')
-                trial_in_mm = get_trial_by_local_protocol_ids(local_protocol_ids)
                 if trial_in_mm:
                     trials_to_update.append((file_name,trial_in_mm['_id'], trial_in_mm['protocol_id'], trial_in_mm['protocol_no'], trial_in_mm['_etag']))
                 else:
@@ -332,20 +374,21 @@ def process_trials():
     logger.info(f"Trials to update: {[trial[0] for trial in trials_to_update]}")
     logger.info(f"Trials to close: {[trial[1] for trial in trials_to_close]}")
 
+    # one directory read answers "is this trial's JSON file present?" for every trial to insert or update
+    with os.scandir(config.TRIAL_DIR) as entries:
+        trial_files = {entry.name for entry in entries if entry.is_file()}
+
     any_success = False
+    run_date = datetime.now().strftime("%Y-%m-%d") # taken once so every trial processed in this run gets the same date
 
     # process new trials
-    any_success = _process_trials_to_insert(trials_to_insert, last_run_date_per_trial, any_success)
+    any_success = _process_trials_to_insert(trials_to_insert, trial_files, last_run_date_per_trial, run_date, any_success)
 
     # process trials to update
-    any_success = _process_trials_to_update(trials_to_update, last_run_date_per_trial, any_success)
+    any_success = _process_trials_to_update(trials_to_update, trial_files, last_run_date_per_trial, run_date, any_success)
 
     # process trials to close
-    any_success = _process_trials_to_close(trials_to_close, last_run_date_per_trial, any_success)
-           
-    # Call run_matchengine to refresh patient-trial matches once after all files processed, if any were successful
-    if any_success:
-        system.run_matchengine()
+    any_success = _process_trials_to_close(trials_to_close, last_run_date_per_trial, run_date, any_success)
     
     # Update LAST_RUN environment variable to current date
     save_last_run_environment(last_run_date_per_trial)
@@ -353,93 +396,143 @@ def process_trials():
     return any_success
 
 
-def _process_trials_to_insert(trials_to_insert:list, last_run_date_per_trial: dict, any_success:bool):
+def _process_trials_to_insert(trials_to_insert:list, trial_files: set, last_run_date_per_trial: dict, run_date: str, any_success:bool):
     """
     Process trials that need to be inserted.
     
     Parameters:
     trials_to_insert (list): List of file names to insert
+    trial_files (set): Names of the files present in the trial folder
+    run_date (str): Date of this run (yyyy-mm-dd), recorded as the last run date of each processed trial
     any_success (bool): Current success status
     
     Returns:
     bool: Updated success status
     """
-    for trial_to_insert in trials_to_insert:
-        file_name = trial_to_insert
+    # protocol_id/protocol_no are handed out serially so they stay unique and follow the file order;
+    # only the POSTs, which mostly wait on the network, run concurrently
+    try:
+        env_variables = load_environment_variables()
+    except Exception as e:
+        logger.error(f"Error loading trial env variables: {e}")
+        return any_success
+
+    prepared_trials = [] # (file_name, trial data with protocol_id/protocol_no set)
+    for file_name in trials_to_insert:
         full_path = os.path.join(config.TRIAL_DIR, file_name)
-        if os.path.isfile(full_path):            
-            try:
-                with open(full_path, 'r', encoding='utf-8') as json_file:
-                    data = json.load(json_file)
-
-                env_variables = load_environment_variables()                    
-                updated_env_variables = update_env_variables(env_variables)
-                updated_data = pre_process_trial_data(data, updated_env_variables)
-                response = post_trial(updated_data)
-                if response and response.status_code >= 200 and response.status_code < 300:
-                    logger.info(f"Successfully inserted {file_name}")
-                    save_environment_variables(updated_env_variables)
-                    last_run_date_per_trial[file_name.split('.')[0]] = datetime.now().strftime("%Y-%m-%d")
-                    any_success = True
-                else:
-                    logger.error(f"Error while posting trial {file_name}, response: {response}")
-            except Exception as e:
-                logger.error(f"Error processing file {file_name}: {e}")
-                continue
-        else:
+        if file_name not in trial_files:
             logger.error(f"File not found: {full_path}")
             continue
-    
+        try:
+            with open(full_path, 'rb') as json_file:
+                data = orjson.loads(json_file.read())
+        except Exception as e:
+            logger.error(f"Error processing file {file_name}: {e}")
+            continue
+        env_variables = update_env_variables(env_variables)
+        prepared_trials.append((file_name, pre_process_trial_data(data, env_variables)))
+
+    if not prepared_trials:
+        return any_success
+
+    inserted_files = []
+    with ThreadPoolExecutor(max_workers=TRIAL_UPLOAD_WORKERS) as executor:
+        for start in range(0, len(prepared_trials), TRIAL_BULK_INSERT_SIZE):
+            batch = prepared_trials[start:start + TRIAL_BULK_INSERT_SIZE]
+            batch_inserted = len(inserted_files)
+            if post_trials_bulk([data for _, data in batch]) is not None:
+                inserted_files.extend(file_name for file_name, _ in batch)
+            else:
+                # post this batch trial by trial so the valid trials still get in
+                logger.warning("Bulk trial insert failed, falling back to per-trial inserts")
+                responses = executor.map(post_trial, [data for _, data in batch])
+                for (file_name, _), response in zip(batch, responses):
+                    if response and response.status_code >= 200 and response.status_code < 300:
+                        inserted_files.append(file_name)
+                    else:
+                        logger.error(f"Error while posting trial {file_name}, response: {response}")
+
+            if len(inserted_files) > batch_inserted:
+                # save after every batch that inserted something, so a crash in a later batch can't hand out the
+                # protocol ids already in the database again on the next run.
+                # The saved counters cover all prepared trials, which leaves gaps but never duplicates
+                save_environment_variables(env_variables)
+
+    for file_name in inserted_files:
+        logger.info(f"Successfully inserted {file_name}")
+        last_run_date_per_trial[file_name.split('.')[0]] = run_date
+
+    if inserted_files:
+        any_success = True
+
     return any_success
 
-def _process_trials_to_update(trials_to_update:list, last_run_date_per_trial: dict, any_success:bool):
+def _process_trials_to_update(trials_to_update:list, trial_files: set, last_run_date_per_trial: dict, run_date: str, any_success:bool):
     """
     Process trials that need to be updated.
     
     Parameters:
     trials_to_update (list): List of tuples containing (file_name, matchminer_id, protocol_id, protocol_no, etag)
+    trial_files (set): Names of the files present in the trial folder
+    run_date (str): Date of this run (yyyy-mm-dd), recorded as the last run date of each processed trial
     any_success (bool): Current success status
     
     Returns:
     bool: Updated success status
     """
-    for trial_to_update in trials_to_update: 
-        file_name = trial_to_update[0]
-        matchminer_id = trial_to_update[1]
-        protocol_id = trial_to_update[2]
-        protocol_no = trial_to_update[3]
-        etag = trial_to_update[4]
+    # each update is an independent file read + PUT, so overlap them on the pooled session
+    with ThreadPoolExecutor(max_workers=TRIAL_UPLOAD_WORKERS) as executor:
+        results = list(executor.map(_update_trial_from_file, trials_to_update, [trial_files] * len(trials_to_update)))
 
-        full_path = os.path.join(config.TRIAL_DIR, file_name)
-        if os.path.isfile(full_path):
-            try:
-                with open(full_path, 'r', encoding='utf-8') as json_file:
-                    data = json.load(json_file)
-                    data['protocol_id'] = protocol_id
-                    data['protocol_no'] = protocol_no
-
-                    response = put_trial(matchminer_id, data, etag)
-                    if response and response.status_code >= 200 and response.status_code < 300:
-                        logger.info(f"Successfully updated {file_name}")                        
-                        last_run_date_per_trial[file_name.split('.')[0]] = datetime.now().strftime("%Y-%m-%d")
-                        any_success = True
-                    else:
-                        logger.error(f"Error while updating trial {json.dumps(data)}, response: {response}")
-            except Exception as e:
-                logger.error(f"Error processing file {file_name}: {e}")
-                continue
-        else:
-            logger.error(f"File not found: {full_path}")
-            continue
+    for trial_to_update, updated in zip(trials_to_update, results):
+        if updated:
+            file_name = trial_to_update[0]
+            last_run_date_per_trial[file_name.split('.')[0]] = run_date
+            any_success = True
     
     return any_success
 
-def _process_trials_to_close(trials_to_close:list, last_run_date_per_trial: dict, any_success:bool):
+def _update_trial_from_file(trial_to_update: tuple, trial_files: set) -> bool:
+    """
+    Update one trial in matchminer system from its JSON file, keeping its existing protocol_id and protocol_no.
+
+    Parameters:
+    trial_to_update (tuple): (file_name, matchminer_id, protocol_id, protocol_no, etag)
+    trial_files (set): Names of the files present in the trial folder
+
+    Returns:
+    bool: True if the trial was updated, False otherwise
+    """
+    file_name, matchminer_id, protocol_id, protocol_no, etag = trial_to_update
+
+    full_path = os.path.join(config.TRIAL_DIR, file_name)
+    if file_name not in trial_files:
+        logger.error(f"File not found: {full_path}")
+        return False
+
+    try:
+        with open(full_path, 'rb') as json_file:
+            data = orjson.loads(json_file.read())
+        data['protocol_id'] = protocol_id
+        data['protocol_no'] = protocol_no
+
+        response = put_trial(matchminer_id, data, etag)
+        if response and response.status_code >= 200 and response.status_code < 300:
+            logger.info(f"Successfully updated {file_name}")
+            return True
+        logger.error(f"Error while updating trial {file_name}, protocol_no: {protocol_no}, status: {getattr(response, 'status_code', None)}")
+        logger.opt(lazy=True).debug("Trial data: {}", lambda: orjson.dumps(data).decode())
+    except Exception as e:
+        logger.error(f"Error processing file {file_name}: {e}")
+    return False
+
+def _process_trials_to_close(trials_to_close:list, last_run_date_per_trial: dict, run_date: str, any_success:bool):
     """
     Process trials that need to be closed.
     
     Parameters:
-    trials_to_close (list): List of tuples containing (matchminer_id, nct_id, trial_data_in_mm)
+    trials_to_close (list): List of tuples containing (matchminer_id, nct_id, trial_summary_in_mm)
+    run_date (str): Date of this run (yyyy-mm-dd), recorded as the last run date of each processed trial
     any_success (bool): Current success status
     
     Returns:
@@ -447,10 +540,11 @@ def _process_trials_to_close(trials_to_close:list, last_run_date_per_trial: dict
     """
     for trial_to_close in trials_to_close:
         matchminer_id = trial_to_close[0]
-        trial_data_in_mm = trial_to_close[2]
-        response = close_trial(matchminer_id, trial_data_in_mm)
+        # the lookup in process_trials only fetched the trial's metadata, but closing PUTs the whole trial back
+        trial_data_in_mm = get_trial_by_mm_id(matchminer_id)
+        response = close_trial(matchminer_id, trial_data_in_mm) if trial_data_in_mm else None
         if response:
-            last_run_date_per_trial[trial_data_in_mm['nct_id']] = datetime.now().strftime("%Y-%m-%d")
+            last_run_date_per_trial[trial_data_in_mm['nct_id']] = run_date
             any_success = True
             logger.info(f"Successfully closed {matchminer_id}")
         else:
@@ -461,46 +555,61 @@ def _process_trials_to_close(trials_to_close:list, last_run_date_per_trial: dict
 def save_to_file(data: dict, file_name :str, format:str):        
     if format == "json":
         path_to_save_at = os.path.join(config.TRIAL_DIR, f'{file_name}.json')
-        with open(path_to_save_at, "w") as json_file: 
-            json.dump(data, json_file)
+        with open(path_to_save_at, "wb") as json_file:
+            json_file.write(orjson.dumps(data))
+
+def _get_trial_in_mm(trial_to_process: dict, trials_by_nct_id: dict):
+    """
+    Look up the trial in matchminer system for a trial_status.csv row, by nct_id or else by its local protocol ids.
+
+    Parameters:
+    trial_to_process (dict): Row from trial_status.csv
+    trials_by_nct_id (dict): Trials already fetched from matchminer system, keyed by nct_id
+
+    Returns:
+    dict or None: Trial data if found, else None
+    """
+    nct_id = trial_to_process['nct_id']
+    if nct_id and nct_id != 'NA':
+        return trials_by_nct_id.get(nct_id)
+    local_protocol_ids_string = trial_to_process['local_protocol_ids']
+    if local_protocol_ids_string and local_protocol_ids_string != 'NA':
+        return get_trial_by_local_protocol_ids(local_protocol_ids_string.split('|'))
+    return None
 
 def _get_trial_file_name(trial_to_process: dict):
     if trial_to_process['nct_id'] != "NA": 
         file_name = trial_to_process['nct_id'] + '.json'
     else:
-        file_name = trial_to_process['local_protocol_ids'].split('|')[0] + '.json' #assuming  that the file name is same as first local protocol id
+        file_name = trial_to_process['local_protocol_ids'].split('|', 1)[0] + '.json' #assuming  that the file name is same as first local protocol id
     return file_name
 
-def get_trial_by_protocol_no(protocol_no: str):
+def _find_trial(where: str, description: str, projection: str = None):
     """
-    Fetch a trial from matchminer system by protocol_no via GET request.
+    Fetch the first trial matching an Eve `where` filter from matchminer system via GET request.
 
     Parameters:
-    protocol_no (str): Protocol number to search for
+    where (str): Serialized Eve `where` filter
+    description (str): What was searched for, used in log messages, e.g. "nct_id: NCT01234567"
+    projection (str): Optional serialized Eve projection, to fetch only some fields of the trial
 
     Returns:
     dict or None: Trial data if found, else None
     """
     try:
-        endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", config.TRIAL_ENDPOINT)}'
-        headers = {
-            'Authorization': f"Basic {config.TOKEN}",
-            'Content-Type': "application/json"
-        }
-        # Build filter for protocol_no
-        params = {
-            'where': json.dumps({"protocol_no": protocol_no})
-        }
-        response = requests.get(endpoint_url, headers=headers, params=params, verify=False)
+        params = {'where': where}
+        if projection:
+            params['projection'] = projection
+        response = SESSION.get(TRIAL_URL, params=params)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         items = data.get("_items", [])
         if items:
             if len(items) > 1:
-                logger.warning(f"Found {len(items)} trials with protocol_no: {protocol_no}. Returning the first one.")
+                logger.warning(f"Found {len(items)} trials with {description}. Returning the first one.")
             return items[0]  # Return the first matching trial
         else:
-            logger.debug(f"No trial found with protocol_no: {protocol_no}")
+            logger.debug(f"No trial found with {description}")
             return None
     except requests.exceptions.HTTPError as err:
         logger.error(f"HTTP error occurred: {err}, {err.response.content}")
@@ -508,6 +617,19 @@ def get_trial_by_protocol_no(protocol_no: str):
         logger.error(f"Other error occurred: {err}")
     return None
 
+def get_trial_by_protocol_no(protocol_no: str, projection: str = None):
+    """
+    Fetch a trial from matchminer system by protocol_no via GET request.
+
+    Parameters:
+    protocol_no (str): Protocol number to search for
+    projection (str): Optional serialized Eve projection, to fetch only some fields of the trial
+
+    Returns:
+    dict or None: Trial data if found, else None
+    """
+    return _find_trial(_where_protocol_no(protocol_no), f"protocol_no: {protocol_no}", projection)
+
 def get_trial_by_mm_id(_id: str):
     """
     Fetch a trial from matchminer system by matchminer id via GET request.
@@ -518,32 +640,7 @@ def get_trial_by_mm_id(_id: str):
     Returns:
     dict or None: Trial data if found, else None
     """
-    try:
-        endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", config.TRIAL_ENDPOINT)}'
-        headers = {
-            'Authorization': f"Basic {config.TOKEN}",
-            'Content-Type': "application/json"
-        }
-        # Build filter for protocol_no
-        params = {
-            'where': json.dumps({"_id": _id})
-        }
-        response = requests.get(endpoint_url, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-        data = response.json()
-        items = data.get("_items", [])
-        if items:
-            if len(items) > 1:
-                logger.warning(f"Found {len(items)} trials with id: {_id}. Returning the first one.")
-            return items[0]  # Return the first matching trial
-        else:
-            logger.info(f"No trial found with id: {_id}")
-            return None
-    except requests.exceptions.HTTPError as err:
-        logger.error(f"HTTP error occurred: {err}, {err.response.content}")
-    except Exception as err:
-        logger.error(f"Other error occurred: {err}")
-    return None
+    return _find_trial(orjson.dumps({"_id": _id}).decode(), f"id: {_id}")
 
 def get_trial_by_nct_id(nct_id: str):
     """
@@ -555,26 +652,32 @@ def get_trial_by_nct_id(nct_id: str):
     Returns:
     dict or None: Trial data if found, else None
     """
+    return _find_trial(orjson.dumps({"nct_id": nct_id}).decode(), f"nct_id: {nct_id}")
+
+def get_trials_by_nct_ids(nct_ids: list):
+    """
+    Fetch the metadata of the trials with any of the given nct_ids from matchminer system, with one GET per batch of nct_ids.
+
+    Parameters:
+    nct_ids (list): NCT IDs to search for
+
+    Returns:
+    dict or None: {nct_id -> trial metadata (TRIAL_SUMMARY_PROJECTION)} for the trials found, or None if a request failed
+    """
     try:
-        endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", config.TRIAL_ENDPOINT)}'
-        headers = {
-            'Authorization': f"Basic {config.TOKEN}",
-            'Content-Type': "application/json"
-        }
-        # Build filter for protocol_no
-        params = {
-            'where': json.dumps({"nct_id": nct_id})
-        }
-        response = requests.get(endpoint_url, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-        data = response.json()
-        items = data.get("_items", [])
-        if items:
-            if len(items) > 1:
-                logger.warning(f"Found {len(items)} trials with nct_id: {nct_id}. Returning the first one.")
-            return items[0]  # Return the first matching trial
-        else:            
-            return None
+        trials_by_nct_id = {}
+        for where in http_session.in_filters("nct_id", nct_ids):
+            params = {
+                'where': orjson.dumps(where).decode(),
+                'projection': TRIAL_SUMMARY_PROJECTION,
+                'max_results': 1000,
+            }
+            for trial in http_session.iter_items(SESSION, TRIAL_URL, params):
+                if trial["nct_id"] in trials_by_nct_id:
+                    logger.warning(f"Found more than one trial with nct_id: {trial['nct_id']}. Using the first one.")
+                    continue
+                trials_by_nct_id[trial["nct_id"]] = trial
+        return trials_by_nct_id
     except requests.exceptions.HTTPError as err:
         logger.error(f"HTTP error occurred: {err}, {err.response.content}")
     except Exception as err:
@@ -591,32 +694,9 @@ def get_trial_by_local_protocol_ids(local_protocol_ids: list):
     Returns:
     dict or None: Trial data if found, else None
     """
-    try:
-        endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", config.TRIAL_ENDPOINT)}'
-        headers = {
-            'Authorization': f"Basic {config.TOKEN}",
-            'Content-Type': "application/json"
-        }
-        # Build filter for protocol_no
-        params = {
-            'where': json.dumps({"protocol_ids":{"$in":[local_protocol_ids.join(',')]}})
-        }
-        response = requests.get(endpoint_url, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-        data = response.json()
-        items = data.get("_items", [])
-        if items:
-            if len(items) > 1:
-                logger.warning(f"Found {len(items)} trials with nct_id: {local_protocol_ids}. Returning the first one.")
-            return items[0]  # Return the first matching trial
-        else:
-            logger.info(f"No trial found with local_protocol_ids: {local_protocol_ids}")
-            return None
-    except requests.exceptions.HTTPError as err:
-        logger.error(f"HTTP error occurred: {err}, {err.response.content}")
-    except Exception as err:
-        logger.error(f"Other error occurred: {err}")
-    return None
+    # match trials that list any of the local protocol ids; the caller only reads the trial's metadata
+    return _find_trial(orjson.dumps({"protocol_ids": {"$in": local_protocol_ids}}).decode(),
+                       f"local_protocol_ids: {local_protocol_ids}", TRIAL_SUMMARY_PROJECTION)
 
 def insert_new_trial(json_file_name :str):
     """
@@ -633,12 +713,12 @@ def insert_new_trial(json_file_name :str):
         raise ValueError("File name with trial JSON must be provided")    
 
     try:
-        with open(json_file_name, 'r', encoding='utf-8') as f:
-            trial_data = json.load(f)
+        with open(json_file_name, 'rb') as f:
+            trial_data = orjson.loads(f.read())
     except FileNotFoundError:
         logger.error(f"File not found: {json_file_name}")
         return False
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.error(f"Invalid JSON in file {json_file_name}: {e}")
         return False
     except Exception as e:
@@ -668,7 +748,7 @@ def update_trial_by_protocol_no(protocol_no: str, updated_json_file_name :str):
         raise ValueError("File name with updated trial JSON must be provided")
     
     # Get trial by protocol_no
-    existing_trial = get_trial_by_protocol_no(protocol_no)
+    existing_trial = get_trial_by_protocol_no(protocol_no, projection=TRIAL_SUMMARY_PROJECTION) # only _id and _etag are used
     if not existing_trial:
         logger.error(f"No trial found with protocol_no: {protocol_no}")
         return False
@@ -677,38 +757,29 @@ def update_trial_by_protocol_no(protocol_no: str, updated_json_file_name :str):
     etag = existing_trial.get('_etag')
 
     try:
-        with open(updated_json_file_name, 'r', encoding='utf-8') as f:
-            updated_data = json.load(f)
+        with open(updated_json_file_name, 'rb') as f:
+            updated_data = orjson.loads(f.read())
     except FileNotFoundError:
         logger.error(f"File not found: {updated_json_file_name}")
         return False
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.error(f"Invalid JSON in file {updated_json_file_name}: {e}")
         return False
     except Exception as e:
         logger.error(f"Unexpected error reading {updated_json_file_name}: {e}")
         return False
 
-    updated_data.pop('_id', None)   
-    updated_data.pop('_etag', None)
-    updated_data.pop('_summary', None)    
-    updated_data.pop('_updated', None)
-    updated_data.pop('_created', None)
-    updated_data.pop('_links', None)
+    updated_data = {key: value for key, value in updated_data.items() if key not in EVE_META_FIELDS}
 
     try:
-        endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", config.TRIAL_ENDPOINT)}/{id}'
-        print(f"Updating trial at {endpoint_url}")
-        headers = {
-            'Authorization': f"Basic {config.TOKEN}",
-            'Content-Type': "application/json",
-            'If-Match': etag  # Use the ETag for optimistic concurrency control
-        }
+        endpoint_url = f'{TRIAL_URL}/{id}'
+        logger.debug(f"Updating trial at {endpoint_url}")
+        headers = {'If-Match': etag}  # Use the ETag for optimistic concurrency control
         # Build filter for protocol_no
         params = {
-            'where': json.dumps({"protocol_no": protocol_no})
+            'where': _where_protocol_no(protocol_no)
         }
-        response = requests.put(endpoint_url, headers=headers, params=params, json=updated_data, verify=False)
+        response = SESSION.put(endpoint_url, headers=headers, params=params, data=orjson.dumps(updated_data))
         response.raise_for_status()
         # Only run matchengine for single update, not in batch
         system.run_matchengine()
@@ -733,24 +804,15 @@ def close_trial(mm_id: str, existing_trial :dict, force_refresh_matchengine: boo
     
     id = mm_id
     etag = existing_trial.get('_etag')
-    existing_trial['status'] = 'closed'    
-
-    existing_trial.pop('_id', None)   
-    existing_trial.pop('_etag', None)
-    existing_trial.pop('_summary', None)    
-    existing_trial.pop('_updated', None)
-    existing_trial.pop('_created', None)
-    existing_trial.pop('_links', None)
+    # copy without Eve's meta fields, so the caller's dict is left untouched
+    closed_trial = {key: value for key, value in existing_trial.items() if key not in EVE_META_FIELDS}
+    closed_trial['status'] = 'closed'
 
     try:
-        endpoint_url = f'{urllib.parse.urljoin(f"{config.MATCHMINER_SERVER}", config.TRIAL_ENDPOINT)}/{id}'
-        print(f"Closing trial at {endpoint_url}")
-        headers = {
-            'Authorization': f"Basic {config.TOKEN}",
-            'Content-Type': "application/json",
-            'If-Match': etag  
-        }
-        response = requests.put(endpoint_url, headers=headers, json=existing_trial, verify=False)
+        endpoint_url = f'{TRIAL_URL}/{id}'
+        logger.debug(f"Closing trial at {endpoint_url}")
+        headers = {'If-Match': etag}
+        response = SESSION.put(endpoint_url, headers=headers, data=orjson.dumps(closed_trial))
         response.raise_for_status()
 
         if force_refresh_matchengine: